@@ -1,26 +1,60 @@
+import functools
+import logging
+import math
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
-from PIL import Image, ExifTags
+import PIL
+from PIL import Image, features
 import zipfile
 from io import BytesIO
 
+logger = logging.getLogger("stitchlogo")
+
+@st.cache_resource
+def _report_pillow_build() -> None:
+    # Runs once per server process. Streamlit leaves the root logger without
+    # a handler at WARNING, so this logger gets its own.
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+    # Pillow-SIMD reports versions like "11.3.0.post0"
+    if ".post" in PIL.__version__:
+        logger.info("Pillow-SIMD %s loaded", PIL.__version__)
+    else:
+        logger.warning("Stock Pillow %s loaded; resizing is not SIMD-accelerated", PIL.__version__)
+    if features.check_feature("libjpeg_turbo"):
+        logger.info("Pillow is linked against libjpeg-turbo")
+    else:
+        logger.warning("Pillow is not linked against libjpeg-turbo; JPEG decode and encode are slower")
+
+_report_pillow_build()
+
 # ——————————————————————————————
 # 1) Fix image orientation via EXIF
 # ——————————————————————————————
+ORIENTATION_TAG = 0x0112
+
+# EXIF orientation -> the lossless transpose that makes the photo upright
+_EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
 def correct_orientation(img: Image.Image) -> Image.Image:
     try:
-        for tag, name in ExifTags.TAGS.items():
-            if name == 'Orientation':
-                orientation_tag = tag
-                break
-        exif = img._getexif()
-        if exif is not None:
-            orient = exif.get(orientation_tag)
-            if orient == 3:
-                img = img.rotate(180, expand=True)
-            elif orient == 6:
-                img = img.rotate(270, expand=True)
-            elif orient == 8:
-                img = img.rotate(90, expand=True)
+        op = _EXIF_TRANSPOSE.get(img.getexif().get(ORIENTATION_TAG))
+        if op is not None:
+            img = img.transpose(op)
     except Exception:
         pass
     return img
@@ -37,59 +71,208 @@ def build_adaptive_template(
     orig_w, orig_h = template.size
     scale = target_height / orig_h
     scaled_w = int(orig_w * scale)
-    scaled = template.resize((scaled_w, target_height), Image.LANCZOS)
 
     left_ratio, center_ratio, right_ratio = slice_ratios
     left_w = int(scaled_w * left_ratio)
     right_w = int(scaled_w * right_ratio)
     center_w = scaled_w - left_w - right_w
 
-    left = scaled.crop((0, 0, left_w, target_height))
-    center = scaled.crop((left_w, 0, left_w + center_w, target_height))
-    right = scaled.crop((left_w + center_w, 0, scaled_w, target_height))
+    # Slice edges in template pixels: resize(box=...) crops and scales each
+    # slice in a single pass instead of resizing the whole template first
+    x1 = left_w / scale
+    x2 = (left_w + center_w) / scale
+    x3 = scaled_w / scale
 
-    if left_w + right_w > target_width:
-        tmp = Image.new("RGB", (left_w + right_w, target_height))
-        tmp.paste(left, (0, 0))
-        tmp.paste(right, (left_w, 0))
-        new_h = int(target_height * (target_width / (left_w + right_w)))
-        return tmp.resize((target_width, new_h), Image.LANCZOS)
+    if left_w + right_w >= target_width:
+        # Too narrow for both end slices: drop the center and shrink the ends
+        # straight from the template to their share of the photo width
+        new_h = max(1, int(target_height * (target_width / (left_w + right_w))))
+        fit_left_w = round(target_width * left_w / (left_w + right_w))
+        out = Image.new("RGB", (target_width, new_h), None)
+        if fit_left_w:
+            left = template.resize((fit_left_w, new_h), Image.LANCZOS, box=(0, 0, x1, orig_h))
+            out.paste(left, (0, 0))
+        if fit_left_w < target_width:
+            right = template.resize(
+                (target_width - fit_left_w, new_h), Image.LANCZOS, box=(x2, 0, x3, orig_h)
+            )
+            out.paste(right, (fit_left_w, 0))
+        return out
     else:
         needed = target_width - left_w - right_w
-        center_stretched = center.resize((needed, target_height), Image.LANCZOS)
-        out = Image.new("RGB", (target_width, target_height))
+        left = template.resize((left_w, target_height), Image.LANCZOS, box=(0, 0, x1, orig_h))
+        center_stretched = template.resize(
+            (needed, target_height), Image.LANCZOS, box=(x1, 0, x2, orig_h)
+        )
+        right = template.resize((right_w, target_height), Image.LANCZOS, box=(x2, 0, x3, orig_h))
+        out = Image.new("RGB", (target_width, target_height), None)
         out.paste(left, (0, 0))
         out.paste(center_stretched, (left_w, 0))
         out.paste(right, (left_w + needed, 0))
         return out
 
+def cached_template_builder(template: Image.Image, slice_ratios, maxsize: int = 8):
+    """Bind build_adaptive_template to one template, memoized on strip size.
+
+    Photos from the same camera share a strip size, so only the first of them
+    pays for the LANCZOS resizes.
+    """
+    return functools.lru_cache(maxsize=maxsize)(
+        functools.partial(build_adaptive_template, template, slice_ratios=slice_ratios)
+    )
+
 # ——————————————————————————————
 # 3) Process a single image
 # ——————————————————————————————
+def strip_height(w: int, h: int, base_ratio: float, exponent: float) -> int:
+    aspect = w / h
+    # Tiny photos would otherwise round to a zero-height strip
+    return max(1, int(w * base_ratio * (aspect ** (-exponent))))
+
 def process_image(
     photo: Image.Image,
-    template: Image.Image,
+    build_template,
     base_ratio: float,
     exponent: float,
-    slice_ratios,
 ) -> Image.Image:
     w, h = photo.size
-    aspect = w / h
-    h1 = int(w * base_ratio * (aspect ** (-exponent)))
-    adapt = build_adaptive_template(
-        template,
-        target_width=w,
-        target_height=h1,
-        slice_ratios=slice_ratios,
-    )
+    h1 = strip_height(w, h, base_ratio, exponent)
+    adapt = build_template(target_width=w, target_height=h1)
     out_h = h + adapt.height
-    out = Image.new("RGB", (w, out_h), (255, 255, 255))
+    # Photo and strip cover every pixel, so skip the fill (color=None)
+    out = Image.new("RGB", (w, out_h), None)
     out.paste(photo, (0, 0))
     out.paste(adapt, (0, h))
     return out
 
+# Spelled out so a build with different defaults can't turn on the slow
+# optimize/progressive passes; 4:2:0 chroma subsampling halves chroma data.
+# Pillow already encodes through libjpeg-turbo here, and calling it directly
+# would first need an np.asarray() copy of the whole canvas, which costs more
+# than the encoder overhead it would save.
+JPEG_OPTIONS = dict(quality=75, optimize=False, progressive=False, subsampling=2)
+
+# Photos whose long side exceeds DRAFT_LONG_SIDE are decoded at a reduced
+# scale where the format allows it; anything still larger than MAX_DIM is
+# rejected rather than stitched
+DRAFT_LONG_SIDE = 4096
+MAX_DIM = 8192
+
+class PhotoRejected(Exception):
+    """A photo that is skipped rather than stitched; the message says why."""
+
+def _process_one(img_f, build_template, base_ratio: float, exponent: float):
+    # Runs on a worker thread: decode, resize and encode all release the GIL.
+    # Raises PhotoRejected for photos that are too large to process.
+    try:
+        photo = Image.open(img_f)
+    except Image.DecompressionBombError:
+        raise PhotoRejected(
+            f"more than {2 * Image.MAX_IMAGE_PIXELS:,} pixels (decompression bomb limit)"
+        ) from None
+    # libjpeg scales huge JPEGs down during the IDCT, so decoding costs output
+    # pixels rather than input pixels. draft() only reduces when both sides
+    # divide by the request, so ask for the photo's own aspect ratio.
+    w, h = photo.size
+    if max(w, h) > DRAFT_LONG_SIDE:
+        s = max(w, h) / DRAFT_LONG_SIDE
+        photo.draft("RGB", (math.ceil(w / s), math.ceil(h / s)))
+    if max(photo.size) > MAX_DIM:
+        raise PhotoRejected(f"larger than {MAX_DIM} px and cannot be downscaled on decode")
+    # convert() copies the whole frame even when the mode already matches,
+    # which it does for almost every JPEG
+    if photo.mode != "RGB":
+        photo = photo.convert("RGB")
+    photo = correct_orientation(photo)
+    stitched = process_image(photo, build_template, base_ratio, exponent)
+    out_buf = BytesIO()
+    stitched.save(out_buf, format="JPEG", **JPEG_OPTIONS)
+    # A view of the encoder's buffer, so the JPEG isn't copied into bytes
+    # just to be handed to ZipFile.writestr
+    return out_buf.getbuffer()
+
+def _iter_photos(files):
+    # Yields (name, file object) lazily, so ZIP members are only read as the
+    # pool has room for them
+    for file in files:
+        if file.name.lower().endswith(".zip"):
+            # UploadedFile is seekable, so ZipFile reads members straight out
+            # of it instead of from a second in-memory copy of the upload
+            file.seek(0)
+            with zipfile.ZipFile(file) as in_zip:
+                for info in in_zip.infolist():
+                    if info.filename.lower().endswith((".jpg", ".jpeg", ".png")):
+                        yield info.filename, BytesIO(in_zip.read(info))
+        else:
+            yield file.name, file
+
 # ——————————————————————————————
-# 4) Streamlit App
+# 4) Template loading
+# ——————————————————————————————
+def _header_size(img_f):
+    # Image.open only parses the header, so this is cheap even for large
+    # uploads. Decompression bombs are rejected later, so they add nothing.
+    try:
+        return Image.open(img_f).size
+    except Image.DecompressionBombError:
+        return 1, 1
+
+def _header_sizes(file):
+    if file.name.lower().endswith(".zip"):
+        with zipfile.ZipFile(file) as in_zip:
+            for info in in_zip.infolist():
+                if info.filename.lower().endswith((".jpg", ".jpeg", ".png")):
+                    with in_zip.open(info) as img_f:
+                        yield _header_size(img_f)
+    else:
+        yield _header_size(file)
+    file.seek(0)
+
+def batch_strip_height(files, base_ratio: float, exponent: float) -> int:
+    """Tallest template strip any photo in the batch will need.
+
+    Both orientations are tried because EXIF rotation happens after decode.
+    """
+    tallest = 0
+    for file in files:
+        for w, h in _header_sizes(file):
+            tallest = max(
+                tallest,
+                strip_height(w, h, base_ratio, exponent),
+                strip_height(h, w, base_ratio, exponent),
+            )
+    return tallest
+
+def open_template(path: str, max_height: int = 0) -> Image.Image:
+    """Open the template, letting libjpeg downscale it when strips are short.
+
+    Nothing is decoded yet, but the returned size is already the drafted one.
+    """
+    template = Image.open(path)
+    if max_height:
+        orig_w, orig_h = template.size
+        # draft() picks the smallest 1/2, 1/4 or 1/8 IDCT scale that still
+        # covers the requested size, so no strip is ever upscaled from it
+        template.draft("RGB", (-(-orig_w * max_height // orig_h), max_height))
+    return template
+
+@st.cache_resource(max_entries=2)
+def _shared_template_builder(path: str, draft_size, slice_ratios, _template: Image.Image):
+    # _template is left out of the cache key; draft_size identifies it
+    return cached_template_builder(_template.convert("RGB"), slice_ratios)
+
+def template_builder(path: str, max_height: int, slice_ratios):
+    """Memoized strip builder shared across reruns and sessions.
+
+    The resource cache is keyed on the drafted template size rather than
+    max_height: draft() has only four outcomes, so batches with different
+    strip heights still share the decoded template and its resized strips.
+    """
+    with open_template(path, max_height) as template:
+        return _shared_template_builder(path, template.size, slice_ratios, template)
+
+# ——————————————————————————————
+# 5) Streamlit App
 # ——————————————————————————————
 TEMPLATE_PATH = 'logo_template.jpeg'  # Place your logo template in the app folder
 
@@ -100,6 +283,8 @@ LEFT_FRAC    = 0.37
 CENTER_FRAC  = 0.38
 RIGHT_FRAC   = 1.0 - LEFT_FRAC - CENTER_FRAC
 SLICE_RATIOS = (LEFT_FRAC, CENTER_FRAC, RIGHT_FRAC)
+ZIP_SPOOL_SIZE = 64 * 1024 * 1024
+MAX_IN_FLIGHT = 2 * (os.cpu_count() or 1)
 
 st.title("📸 Photo + Logo Template Stitcher")
 
@@ -122,45 +307,44 @@ if st.button("Process All"):
         if total_size > 200 * 1024 * 1024:
             st.error("Total upload size exceeds 200 MB. Please reduce the upload.")
         else:
+            max_h1 = batch_strip_height(uploads, BASE_RATIO, EXPONENT)
             try:
-                template = Image.open(TEMPLATE_PATH).convert("RGB")
+                build_template = template_builder(TEMPLATE_PATH, max_h1, SLICE_RATIOS)
             except Exception:
                 st.error(f"Cannot load template from '{TEMPLATE_PATH}'.")
             else:
-                zip_buf = BytesIO()
-                with zipfile.ZipFile(zip_buf, mode="w") as zf:
-                    for file in uploads:
-                        name = file.name.lower()
-                        if name.endswith(".zip"):
-                            with zipfile.ZipFile(BytesIO(file.read())) as in_zip:
-                                for info in in_zip.infolist():
-                                    if info.filename.lower().endswith((".jpg", ".jpeg", ".png")):
-                                        with in_zip.open(info) as img_f:
-                                            photo = Image.open(img_f).convert("RGB")
-                                            photo = correct_orientation(photo)
-                                            stitched = process_image(
-                                                photo, template,
-                                                BASE_RATIO, EXPONENT, SLICE_RATIOS
-                                            )
-                                            out_buf = BytesIO()
-                                            stitched.save(out_buf, format="JPEG")
-                                            zf.writestr(f"stitched_{info.filename}", out_buf.getvalue())
-                                            out_buf.close()
-                        else:
-                            photo = Image.open(file).convert("RGB")
-                            photo = correct_orientation(photo)
-                            stitched = process_image(
-                                photo, template,
-                                BASE_RATIO, EXPONENT, SLICE_RATIOS
-                            )
-                            out_buf = BytesIO()
-                            stitched.save(out_buf, format="JPEG")
-                            zf.writestr(f"stitched_{file.name}", out_buf.getvalue())
-                            out_buf.close()
-                zip_buf.seek(0)
-                st.download_button(
-                    "Download All as ZIP",
-                    data=zip_buf,
-                    file_name="stitched_images.zip",
-                    mime="application/zip"
-                )
+                # Small batches stay in RAM, large ones spill to disk while the
+                # archive is built. The JPEGs are already compressed, so they
+                # are stored rather than deflated.
+                with tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_SIZE) as zip_buf:
+                    with zipfile.ZipFile(zip_buf, mode="w", compression=zipfile.ZIP_STORED) as zf, \
+                            ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+                        # Only a bounded number of photos are decoded or
+                        # waiting to be written at any time. Results are written
+                        # from this thread in upload order, so the ZipFile is
+                        # never touched concurrently.
+                        def write(name, job):
+                            try:
+                                data = job.result()
+                            except PhotoRejected as e:
+                                st.error(f"Skipped '{name}': {e}.")
+                            else:
+                                zf.writestr(f"stitched_{name}", data)
+
+                        jobs = deque()
+                        for name, img_f in _iter_photos(uploads):
+                            jobs.append((name, pool.submit(
+                                _process_one, img_f, build_template,
+                                BASE_RATIO, EXPONENT
+                            )))
+                            if len(jobs) >= MAX_IN_FLIGHT:
+                                write(*jobs.popleft())
+                        for name, job in jobs:
+                            write(name, job)
+                    zip_buf.seek(0)
+                    st.download_button(
+                        "Download All as ZIP",
+                        data=zip_buf.read(),
+                        file_name="stitched_images.zip",
+                        mime="application/zip"
+                    )